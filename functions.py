@@ -1,19 +1,43 @@
 import math
 import itertools
 import numpy as np
-import pandas as pd
 import networkx as nx
-import cdlib
-import cdlib_quality_measures_weighted
+# cdlib, cdlib_quality_measures_weighted, pandas and scipy are imported on first use, because they are slow to import
 
-def merge_bases_into_nodes(communities_list):
-    communities_dict = dict()
-    for i, community_containing_base in enumerate(communities_list):
-        communities_dict[i] = set()
-        for base in community_containing_base:
-            communities_dict[i] = communities_dict[i] | set(base)
+def get_membership_matrix(communities, nodes_count, node_index=None):
+    """
+    Sparse CSR matrix of shape (len(communities), nodes_count) with ones for nodes of communities.
+    Nodes are integer ids, otherwise node_index maps node to column.
+    """
+    import scipy.sparse
+    rows = np.repeat(np.arange(len(communities)), [len(community) for community in communities])
+    if node_index is None:
+        columns = np.fromiter(itertools.chain.from_iterable(communities), dtype=np.intp, count=len(rows))
+    else:
+        columns = np.fromiter((node_index[node] for node in itertools.chain.from_iterable(communities)), dtype=np.intp, count=len(rows))
+    membership = scipy.sparse.csr_matrix((np.ones(len(rows), dtype=np.int32), (rows, columns)), shape=(len(communities), nodes_count))
+    membership.sum_duplicates()
+    membership.data[:] = 1
+    return membership
 
-    new_array = [set(sorted([node for node in comp])) for comp in communities_dict.values() if len(comp) > 1]
+def merge_bases_into_nodes(communities_list):
+    bases = list()
+    communities_bases = list()
+    for community_containing_base in communities_list:
+        communities_bases.append(range(len(bases), len(bases) + len(community_containing_base)))
+        bases.extend(community_containing_base)
+    if len(bases) == 0:
+        return list()
+    nodes_count = max([max(base) for base in bases]) + 1
+    # (communities x bases) @ (bases x nodes) gives nodes of communities
+    communities_membership = get_membership_matrix(communities_bases, len(bases)) @ get_membership_matrix(bases, nodes_count)
+
+    new_array = list()
+    for i in range(communities_membership.shape[0]):
+        nodes = communities_membership.indices[communities_membership.indptr[i]:communities_membership.indptr[i+1]]
+        if len(nodes) > 1:
+            new_array.append(set(nodes.tolist()))
+    # order of communities from np.unique is kept, postprocess_for_full_cover breaks ties by community index
     return np.unique(new_array) if len(new_array) > 1 else new_array
 
 
@@ -113,6 +137,8 @@ def calculate_weighted_conductance(G, communities_list, weight_param):
     return np.mean(conductance_list)
 
 def cdlib_communities_quality_check(graph, communities, weight_param):
+    import cdlib
+    import cdlib_quality_measures_weighted
     if type(communities) is object:
         communities_cdlib_object = communities
     else:
@@ -146,6 +172,7 @@ def cdlib_communities_quality_check(graph, communities, weight_param):
     return evaluation_dict
 
 def get_overlapping_evaluation_dict(graph, communities, weight_param, gt_communities=None):
+    import cdlib
     results = dict()
     cdlib_communitites_obj = type('obj', (object,), {'communities':communities})
     cdlib_communitites_complete_obj = type('obj', (object,), {'communities':get_full_cover_for_communities(communities, graph.nodes())})
@@ -233,14 +260,27 @@ def postprocess_for_full_cover(communities:list, nodes:list, graph: nx.Graph):
             if node in nodes_set:
                 nodes_set.remove(node)
     missing_node_community_assigment = dict()
-    for node in nodes_set:
-        neighbours = set(graph.neighbors(node))
-        neighbours_communities = [len(comm & neighbours) for e, comm in enumerate(communities)]
-        if any([c > 1 for c in neighbours_communities]):
-            comm_id_max = np.argmax(neighbours_communities)
-            missing_node_community_assigment[node] = comm_id_max
-        else:
-            missing_node_community_assigment[node] = -1
+    missing_nodes = list(nodes_set)
+    if len(missing_nodes) > 0 and len(communities) > 0:
+        import scipy.sparse
+        nodelist = list(graph.nodes())
+        node_index = {node: i for i, node in enumerate(nodelist)}
+        # CSR adjacency rows of missing nodes only
+        neighbours_lists = [list(graph.neighbors(node)) for node in missing_nodes]
+        indptr = np.cumsum([0] + [len(neighbours) for neighbours in neighbours_lists])
+        indices = np.fromiter((node_index[n] for neighbours in neighbours_lists for n in neighbours), dtype=np.intp, count=indptr[-1])
+        adjacency_missing = scipy.sparse.csr_matrix((np.ones(len(indices), dtype=np.int32), indices, indptr), shape=(len(missing_nodes), len(nodelist)))
+        # (missing nodes x nodes) @ (nodes x communities) counts neighbours of missing nodes in communities
+        neighbours_communities = (adjacency_missing @ get_membership_matrix(communities, len(nodelist), node_index).T).tocsr()
+        neighbours_communities.sort_indices()
+    for i, node in enumerate(missing_nodes):
+        missing_node_community_assigment[node] = -1
+        if len(communities) == 0:
+            continue
+        counts = neighbours_communities.data[neighbours_communities.indptr[i]:neighbours_communities.indptr[i+1]]
+        if len(counts) > 0 and counts.max() > 1:
+            comm_ids = neighbours_communities.indices[neighbours_communities.indptr[i]:neighbours_communities.indptr[i+1]]
+            missing_node_community_assigment[node] = comm_ids[np.argmax(counts)]
     for node in nodes_set:
         if missing_node_community_assigment[node] != -1:
             communities[missing_node_community_assigment[node]].add(node)
@@ -249,6 +289,7 @@ def postprocess_for_full_cover(communities:list, nodes:list, graph: nx.Graph):
     return communities
 
 def get_best_split_results(df_results):
+    import pandas as pd
     best_results_list = list()
     for modularity_measure in ['modularity_eq']:        
         df_tmp = df_results.sort_values(modularity_measure, ascending=False).reset_index()
@@ -258,10 +299,14 @@ def get_best_split_results(df_results):
         best_results_list.append(best)
     return pd.DataFrame.from_dict(best_results_list)
 
-def get_communities_ct_diameter(communities, ct_distance_matrix):
+def get_communities_ct_diameter(communities, ct_distance_matrix, chunk_size=2**22):
+    # maximum is reduced over blocks of rows, so at most chunk_size elements of submatrix are gathered at once
     communities_diameter = list()
     for community in communities:
-        communities_diameter.append(np.max(ct_distance_matrix[np.ix_(list(community), list(community))]))
+        nodes = np.fromiter(community, dtype=np.intp, count=len(community))
+        rows_in_chunk = max(1, chunk_size // len(nodes))
+        diameter = max([ct_distance_matrix[np.ix_(nodes[start:start+rows_in_chunk], nodes)].max() for start in range(0, len(nodes), rows_in_chunk)])
+        communities_diameter.append(diameter)
     return communities_diameter
 
 def silhouette_score_for_overlapping_communities(communities, ct_distance_matrix):
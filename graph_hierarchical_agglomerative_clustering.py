@@ -1,14 +1,31 @@
 import networkx as nx
 import numpy as np
 import enum
+import copy
+import math
+from collections import defaultdict
 
 class GHACLinkageMethod(enum.Enum):
     SINGLE = 1
     COMPLETE = 2
     AVERAGE = 3
 
+def get_linkage_clusters(linkage_matrix: np.ndarray):
+    # clusters created by merges in linkage matrix as sets of bases ids
+    bases_count = linkage_matrix.shape[0] + 1
+    clusters = [frozenset([i]) for i in range(bases_count)]
+    for row in linkage_matrix:
+        clusters.append(clusters[int(row[0])] | clusters[int(row[1])])
+    return clusters[bases_count:]
+
+def get_merge_order_difference(linkage_matrix: np.ndarray, linkage_matrix_exact: np.ndarray):
+    # ratio of merges in linkage_matrix (e.g. from approximate mode) creating cluster which is not in the exact hierarchy
+    clusters_exact = set(get_linkage_clusters(linkage_matrix_exact))
+    clusters = get_linkage_clusters(linkage_matrix)
+    return sum([cluster not in clusters_exact for cluster in clusters]) / len(clusters)
+
 class GraphAgglomerativeClusteringClosedTrail():
-    def __init__(self, graph: nx.Graph, ct_linkage_method: GHACLinkageMethod, ct_distance_matrix: np.ndarray, bases: list, weight_attribute=None):
+    def __init__(self, graph: nx.Graph, ct_linkage_method: GHACLinkageMethod, ct_distance_matrix: np.ndarray, bases: list, weight_attribute=None, overlap_denominators_cache: dict=None, ct_approximation_tolerance: float=None, random_state=None):
         self.graph = graph
         self.m = nx.number_of_edges(self.graph)
         self.degrees = dict(nx.degree(self.graph))
@@ -19,24 +36,69 @@ class GraphAgglomerativeClusteringClosedTrail():
         self.wt = None
         if weight_attribute is not None:
             self.wt = sum([w for u,v,w in self.graph.edges(data=weight_attribute)])
+        # denominators depend only on the overlap, the cache is used only when it is shared between instances on the same graph
+        self.overlap_denominators_cache = overlap_denominators_cache
+        # approximate mode for AVERAGE linkage, average CT distance between clusters is estimated on uniform random samples
+        # of k = ceil(3 / tolerance^2) nodes of each cluster larger than k. For disjoint clusters the estimate is unbiased and its
+        # standard error is at most tolerance * std of CT distances between the clusters (var <= std^2 * (1/k + 1/k + 1/k^2)).
+        # For overlapping clusters the samples without overlap nodes are used, so they may be smaller than k.
+        # The bound is for distances only, it does not bound changes of the merge order (see get_merge_order_difference).
+        # It pays off only when clusters grow far beyond k nodes, e.g. 80 disjoint bases of 100 nodes (8000 nodes): 2.2 s exact,
+        # 1.0 s with tolerance 0.1. For a few hundred nodes in clique bases the run time is dominated by overlap denominators.
+        self.ct_approximation_sample_size = None
+        if ct_approximation_tolerance is not None:
+            if ct_approximation_tolerance <= 0:
+                raise ValueError("ct_approximation_tolerance must be positive.")
+            if ct_linkage_method != GHACLinkageMethod.AVERAGE:
+                raise ValueError("ct_approximation_tolerance is supported only for AVERAGE linkage.")
+            self.ct_approximation_sample_size = math.ceil(3 / ct_approximation_tolerance**2)
+        self.rng = np.random.default_rng(random_state)
         self.reset()
         self.linkage_matrix = None
         
     def reset(self):
+        self.agglomeration_started = False
         self.clusters_map_of_sets = dict()
         self.clusters_map_of_edges_sets = dict() # this dictionary contains list of edges for conducting subgraph for clusters
+        self.clusters_map_of_nodes_arrays = dict() # node ids of clusters as arrays for indexing of ct_distance_matrix
+        self.node_clusters_index = defaultdict(set) # inverted index from node to ids of live clusters containing it
+        self.clusters_map_of_samples = dict() # representative nodes of clusters for approximate mode
         for i, base in enumerate(self.bases):
             self.clusters_map_of_sets[i] = set(base)
+            self.clusters_map_of_nodes_arrays[i] = self.get_nodes_array(self.clusters_map_of_sets[i])
+            if self.ct_approximation_sample_size is not None:
+                self.clusters_map_of_samples[i] = self.sample_nodes(self.clusters_map_of_nodes_arrays[i], self.ct_approximation_sample_size)
+            for node in base:
+                self.node_clusters_index[node].add(i)
             graph_overlap = nx.subgraph(self.graph, base)
             self.clusters_map_of_edges_sets[i] = set()
             for u,v in nx.edges(graph_overlap):
                 self.clusters_map_of_edges_sets[i].add((min(u,v), max(u,v)))
         
-    def run(self):
+    def copy_with_linkage_method(self, ct_linkage_method: GHACLinkageMethod):
+        # copy of not yet agglomerated clusters, it shares bases, edge sets and overlap denominators cache
+        if self.agglomeration_started:
+            raise RuntimeError("copy_with_linkage_method must be called before run(), or after reset().")
+        if self.ct_approximation_sample_size is not None and ct_linkage_method != GHACLinkageMethod.AVERAGE:
+            raise ValueError("ct_approximation_tolerance is supported only for AVERAGE linkage.")
+        ghac = copy.copy(self)
+        ghac.ct_linkage_method = ct_linkage_method
+        ghac.clusters_map_of_sets = dict(self.clusters_map_of_sets)
+        ghac.clusters_map_of_edges_sets = dict(self.clusters_map_of_edges_sets)
+        ghac.clusters_map_of_nodes_arrays = dict(self.clusters_map_of_nodes_arrays)
+        ghac.node_clusters_index = defaultdict(set, {node: set(node_clusters) for node, node_clusters in self.node_clusters_index.items()})
+        ghac.clusters_map_of_samples = dict(self.clusters_map_of_samples)
+        ghac.rng = copy.deepcopy(self.rng)
+        ghac.linkage_matrix = None
+        return ghac
+
+    def run(self, distance_matrix: np.ndarray=None):
         bases_count = len(self.bases)
-        print('Start pairwise distance matrix calculation.')
-        distance_matrix = self.calculate_pairwise_distance_matrix()
-        print('Calculation finished.')
+        self.agglomeration_started = True
+        if distance_matrix is None:
+            print('Start pairwise distance matrix calculation.')
+            distance_matrix = self.calculate_pairwise_distance_matrix()
+            print('Calculation finished.')
         linkage_matrix = np.empty((bases_count - 1, 4))
         linkage_clusters_reuse_translation = list(range(bases_count))
         np.fill_diagonal(distance_matrix, 999)
@@ -52,15 +114,23 @@ class GraphAgglomerativeClusteringClosedTrail():
             linkage_matrix[i, 2] = distance_matrix[m1, m2]
             linkage_clusters_reuse_translation[m1] = bases_count + i
             
+            nodes_of_m2 = self.clusters_map_of_sets[m2]
             self.clusters_map_of_sets[m1] = self.clusters_map_of_sets[m1] | self.clusters_map_of_sets[m2]
             self.clusters_map_of_sets[m2] = None
             self.clusters_map_of_edges_sets[m1] = self.clusters_map_of_edges_sets[m1] | self.clusters_map_of_edges_sets[m2]
             self.clusters_map_of_edges_sets[m2] = None
+            self.clusters_map_of_nodes_arrays[m1] = self.get_nodes_array(self.clusters_map_of_sets[m1])
+            self.clusters_map_of_nodes_arrays[m2] = None
+            if self.ct_approximation_sample_size is not None:
+                self.clusters_map_of_samples[m1] = self.sample_nodes(self.clusters_map_of_nodes_arrays[m1], self.ct_approximation_sample_size)
+                self.clusters_map_of_samples[m2] = None
+            self.update_node_clusters_index(m1, m2, nodes_of_m2)
             linkage_matrix[i, 3] = len(self.clusters_map_of_sets[m1])
 
+            overlapping_clusters = self.get_overlapping_clusters(m1)
             for idx in range(bases_count):
                 if self.clusters_map_of_sets[idx] is not None and idx != m1:
-                    d = self.calculate_ct_method_between_clusters(self.clusters_map_of_sets[m1], self.clusters_map_of_sets[idx], self.clusters_map_of_edges_sets[m1], self.clusters_map_of_edges_sets[idx])
+                    d = self.calculate_distance_between_clusters(m1, idx, overlapping_clusters)
                     if d>0 and distance_matrix[m1, idx] == 997:
                         continue
                     distance_matrix[m1, idx] = d
@@ -77,42 +147,162 @@ class GraphAgglomerativeClusteringClosedTrail():
         bases_count = len(self.bases)
         clusters_distance_matrix = np.zeros((bases_count, bases_count))
         for i in range(bases_count):
+            overlapping_clusters = self.get_overlapping_clusters(i)
             for j in range(i+1, bases_count):
-                d = self.calculate_ct_method_between_clusters(self.clusters_map_of_sets[i], self.clusters_map_of_sets[j], self.clusters_map_of_edges_sets[i], self.clusters_map_of_edges_sets[j])
+                d = self.calculate_distance_between_clusters(i, j, overlapping_clusters)
                 clusters_distance_matrix[i, j] = d
                 clusters_distance_matrix[j, i] = d
         return clusters_distance_matrix
 
-    def calculate_ct_method_between_clusters(self, cluster1, cluster2, edges_list1, edges_list2):
-        intersect = cluster1 & cluster2
-        submatrix_indices = np.ix_(list(cluster1 - intersect), list(cluster2 - intersect))
-        submatrix = self.ct_distance_matrix[submatrix_indices]        
-        if submatrix.size == 0:
-            return 0
+    @staticmethod
+    def get_nodes_array(cluster):
+        return np.fromiter(cluster, dtype=np.intp, count=len(cluster))
+
+    def sample_nodes(self, nodes, sample_size):
+        if len(nodes) <= sample_size:
+            return nodes
+        return self.rng.choice(nodes, sample_size, replace=False)
+
+    def update_node_clusters_index(self, m1, m2, nodes_of_m2):
+        # cluster m2 was merged into m1, only entries of its nodes change
+        for node in nodes_of_m2:
+            node_clusters = self.node_clusters_index[node]
+            node_clusters.discard(m2)
+            node_clusters.add(m1)
+
+    def get_overlapping_clusters(self, cluster_id):
+        overlapping_clusters = set()
+        for node in self.clusters_map_of_sets[cluster_id]:
+            overlapping_clusters |= self.node_clusters_index[node]
+        overlapping_clusters.discard(cluster_id)
+        return overlapping_clusters
+
+    def calculate_distance_between_clusters(self, cluster_id1, cluster_id2, overlapping_clusters):
+        samples1, samples2 = None, None
+        if self.ct_approximation_sample_size is not None:
+            samples1, samples2 = self.clusters_map_of_samples[cluster_id1], self.clusters_map_of_samples[cluster_id2]
+            # complete samples of small clusters give the exact distance
+            if len(samples1) == len(self.clusters_map_of_sets[cluster_id1]) and len(samples2) == len(self.clusters_map_of_sets[cluster_id2]):
+                samples1, samples2 = None, None
+        # clusters without shared nodes need only the CT aggregate, no set intersections
+        if cluster_id2 not in overlapping_clusters:
+            if samples1 is not None:
+                return self.calculate_ct_aggregate(samples1, samples2)
+            return self.calculate_ct_aggregate(self.clusters_map_of_nodes_arrays[cluster_id1], self.clusters_map_of_nodes_arrays[cluster_id2])
+        return self.calculate_ct_method_between_clusters(self.clusters_map_of_sets[cluster_id1], self.clusters_map_of_sets[cluster_id2], self.clusters_map_of_edges_sets[cluster_id1], self.clusters_map_of_edges_sets[cluster_id2], samples1, samples2)
+
+    @staticmethod
+    def aggregate_submatrix(submatrix, ct_linkage_method):
         d = None
-        if self.ct_linkage_method == GHACLinkageMethod.SINGLE:
+        if ct_linkage_method == GHACLinkageMethod.SINGLE:
             d = np.min(submatrix)
-        elif self.ct_linkage_method == GHACLinkageMethod.COMPLETE:
+        elif ct_linkage_method == GHACLinkageMethod.COMPLETE:
             d = np.max(submatrix)
-        elif self.ct_linkage_method == GHACLinkageMethod.AVERAGE:
+        elif ct_linkage_method == GHACLinkageMethod.AVERAGE:
             d = np.average(submatrix)
+        return d
+
+    def calculate_ct_aggregate(self, nodes1, nodes2):
+        submatrix = self.ct_distance_matrix[np.ix_(nodes1, nodes2)]
+        if submatrix.size == 0:
+            return 0
+        return self.aggregate_submatrix(submatrix, self.ct_linkage_method)
+
+    def calculate_ct_method_between_clusters(self, cluster1, cluster2, edges_list1, edges_list2, samples1=None, samples2=None):
+        intersect = cluster1 & cluster2
+        nodes1, nodes2 = None, None
+        if samples1 is not None:
+            intersect_array = self.get_nodes_array(intersect)
+            nodes1 = samples1[~np.isin(samples1, intersect_array)]
+            nodes2 = samples2[~np.isin(samples2, intersect_array)]
+        # exact calculation when samples consist of overlap only
+        if nodes1 is None or len(nodes1) == 0 or len(nodes2) == 0:
+            nodes1, nodes2 = list(cluster1 - intersect), list(cluster2 - intersect)
+        d = self.calculate_ct_aggregate(nodes1, nodes2)
+        if d == 0:
+            return 0
 
         if len(intersect) > 0:
-            if len(intersect) == 1:
-                graph_overlap = nx.subgraph(self.graph, [node for node in intersect])
-            else:
-                graph_overlap = nx.edge_subgraph(self.graph, edges_list1 & edges_list2).copy()
-                graph_overlap.add_nodes_from(intersect)
-            cliques_in_overlap = list(nx.find_cliques(graph_overlap))
-            max_clique_size = len(max(cliques_in_overlap, key=len)) if len(cliques_in_overlap) > 0 else 0
-            denominator = 1 + max_clique_size
-            
-            if self.weight_attribute is not None:
-                cliques_in_overlap = [clique for clique in cliques_in_overlap if len(clique) == max_clique_size]
-                weighted_cliques_list = [sum([w/self.wt for w in nx.get_edge_attributes(nx.subgraph(graph_overlap, clique), name=self.weight_attribute).values()]) for clique in cliques_in_overlap]
-                max_overlap_weight = max(weighted_cliques_list) if len(weighted_cliques_list) > 0 else 0
-                denominator += max_overlap_weight
-            
-            d /= denominator
+            d /= self.calculate_overlap_denominator(intersect, edges_list1, edges_list2)
         return d
 
+    def calculate_overlap_denominator(self, intersect, edges_list1, edges_list2):
+        edges_overlap = edges_list1 & edges_list2 if len(intersect) > 1 else set()
+        key = None
+        if self.overlap_denominators_cache is not None:
+            key = (frozenset(intersect), frozenset(edges_overlap))
+            if key in self.overlap_denominators_cache:
+                return self.overlap_denominators_cache[key]
+
+        if len(intersect) == 1:
+            graph_overlap = nx.subgraph(self.graph, [node for node in intersect])
+        else:
+            graph_overlap = nx.edge_subgraph(self.graph, edges_overlap).copy()
+            graph_overlap.add_nodes_from(intersect)
+        cliques_in_overlap = list(nx.find_cliques(graph_overlap))
+        max_clique_size = len(max(cliques_in_overlap, key=len)) if len(cliques_in_overlap) > 0 else 0
+        denominator = 1 + max_clique_size
+        
+        if self.weight_attribute is not None:
+            cliques_in_overlap = [clique for clique in cliques_in_overlap if len(clique) == max_clique_size]
+            weighted_cliques_list = [sum([w/self.wt for w in nx.get_edge_attributes(nx.subgraph(graph_overlap, clique), name=self.weight_attribute).values()]) for clique in cliques_in_overlap]
+            max_overlap_weight = max(weighted_cliques_list) if len(weighted_cliques_list) > 0 else 0
+            denominator += max_overlap_weight
+
+        if key is not None:
+            self.overlap_denominators_cache[key] = denominator
+        return denominator
+
+class GraphAgglomerativeClusteringClosedTrailMultiLinkage():
+    """
+    Runs wGHAC for several linkage methods on the same bases. Clusters initialization, overlap denominators
+    and the initial pairwise distance matrices are calculated once, agglomerations then run one after another.
+    """
+    def __init__(self, graph: nx.Graph, ct_distance_matrix: np.ndarray, bases: list, weight_attribute=None, ct_linkage_methods: list=None):
+        # duplicated methods are dropped, every method is agglomerated once
+        self.ct_linkage_methods = list(dict.fromkeys(ct_linkage_methods)) if ct_linkage_methods is not None else list(GHACLinkageMethod)
+        self.overlap_denominators_cache = dict()
+        ghac = GraphAgglomerativeClusteringClosedTrail(graph, self.ct_linkage_methods[0], ct_distance_matrix, bases, weight_attribute, self.overlap_denominators_cache)
+        self.ghacs = dict()
+        for ct_linkage_method in self.ct_linkage_methods:
+            self.ghacs[ct_linkage_method] = ghac if ct_linkage_method == ghac.ct_linkage_method else ghac.copy_with_linkage_method(ct_linkage_method)
+        self.linkage_matrices = None
+
+    def run(self):
+        print('Start pairwise distance matrices calculation.')
+        distance_matrices = self.calculate_pairwise_distance_matrices()
+        print('Calculation finished.')
+        self.linkage_matrices = dict()
+        for ct_linkage_method in self.ct_linkage_methods:
+            print(f'Agglomeration with {ct_linkage_method.name} linkage.')
+            self.linkage_matrices[ct_linkage_method] = self.ghacs[ct_linkage_method].run(distance_matrices[ct_linkage_method])
+        return self.linkage_matrices
+
+    def calculate_pairwise_distance_matrices(self):
+        # every pair of bases is processed once and its submatrix is aggregated by all linkage methods
+        ghac = self.ghacs[self.ct_linkage_methods[0]]
+        bases_count = len(ghac.bases)
+        distance_matrices = {ct_linkage_method: np.zeros((bases_count, bases_count)) for ct_linkage_method in self.ct_linkage_methods}
+        for i in range(bases_count):
+            overlapping_clusters = ghac.get_overlapping_clusters(i)
+            for j in range(i+1, bases_count):
+                intersect = None
+                if j in overlapping_clusters:
+                    intersect = ghac.clusters_map_of_sets[i] & ghac.clusters_map_of_sets[j]
+                    submatrix_indices = np.ix_(list(ghac.clusters_map_of_sets[i] - intersect), list(ghac.clusters_map_of_sets[j] - intersect))
+                else:
+                    submatrix_indices = np.ix_(ghac.clusters_map_of_nodes_arrays[i], ghac.clusters_map_of_nodes_arrays[j])
+                submatrix = ghac.ct_distance_matrix[submatrix_indices]
+                if submatrix.size == 0:
+                    continue
+                denominator = None
+                if intersect is not None:
+                    denominator = ghac.calculate_overlap_denominator(intersect, ghac.clusters_map_of_edges_sets[i], ghac.clusters_map_of_edges_sets[j])
+                for ct_linkage_method, distance_matrix in distance_matrices.items():
+                    d = ghac.aggregate_submatrix(submatrix, ct_linkage_method)
+                    if denominator is not None:
+                        d /= denominator
+                    distance_matrix[i, j] = d
+                    distance_matrix[j, i] = d
+        return distance_matrices
+
@@ -0,0 +1,63 @@
+import numpy as np
+import os
+import shutil
+
+import functions
+
+"""
+Writer of wGHAC results into compact binary files
+
+Output directory contains:
+- hierarchy.npz   linkage matrix and bases of the hierarchy (bases as CSR membership arrays)
+- covers/level_<level>.npz   cover of the graph for every evaluated level as CSR membership arrays,
+                             it is written as soon as the level is evaluated
+- levels.parquet  table of metrics for evaluated levels, written on close
+All CSR membership arrays have nodes_count columns (number of nodes of the graph), so covers of all levels share one column space.
+Results of a previous run in the output directory are removed when the writer is created.
+"""
+
+class GHACResultsWriter():
+    def __init__(self, output_dir: str):
+        self.output_dir = output_dir
+        self.covers_dir = os.path.join(output_dir, 'covers')
+        shutil.rmtree(self.covers_dir, ignore_errors=True)
+        for filename in ['hierarchy.npz', 'levels.parquet']:
+            if os.path.exists(os.path.join(output_dir, filename)):
+                os.remove(os.path.join(output_dir, filename))
+        os.makedirs(self.covers_dir, exist_ok=True)
+        self.levels_rows = list()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def write_hierarchy(self, linkage_matrix: np.ndarray, bases: list, nodes_count: int):
+        bases_membership = get_csr_membership(bases, nodes_count)
+        np.savez_compressed(os.path.join(self.output_dir, 'hierarchy.npz'), linkage_matrix=linkage_matrix, **bases_membership)
+
+    def write_level(self, level, cd_evaluation: dict, nodes_count: int):
+        cover_filename = os.path.join('covers', f'level_{int(level)}.npz')
+        np.savez_compressed(os.path.join(self.output_dir, cover_filename), **get_csr_membership(cd_evaluation['communities'], nodes_count))
+        row = {k: v for k, v in cd_evaluation.items() if k != 'communities'}
+        row['cover_file'] = cover_filename
+        self.levels_rows.append(row)
+
+    def close(self):
+        import pandas as pd
+        if len(self.levels_rows) == 0:
+            return
+        pd.DataFrame(self.levels_rows).infer_objects().to_parquet(os.path.join(self.output_dir, 'levels.parquet'), index=False)
+        self.levels_rows = list()
+
+def get_csr_membership(communities: list, nodes_count: int):
+    membership = functions.get_membership_matrix(communities, nodes_count)
+    membership.sort_indices()
+    return {'indptr': membership.indptr, 'indices': membership.indices, 'shape': np.array(membership.shape)}
+
+def load_communities(filename: str):
+    # communities (or bases) stored by GHACResultsWriter as list of sets of nodes
+    with np.load(filename) as data:
+        indptr, indices = data['indptr'], data['indices']
+        return [set(indices[indptr[i]:indptr[i+1]].tolist()) for i in range(len(indptr) - 1)]
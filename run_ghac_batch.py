@@ -0,0 +1,177 @@
+import networkx as nx
+import numpy as np
+import argparse
+import json
+import pickle
+import os
+import hashlib
+import traceback
+import concurrent.futures
+
+from graph_hierarchical_agglomerative_clustering import GHACLinkageMethod, GraphAgglomerativeClusteringClosedTrail, get_merge_order_difference
+import run_ghac_community_detection
+from results_writer import GHACResultsWriter
+
+"""
+Batch runner of wGHAC over several graphs and configurations
+
+Manifest is a JSON file, e.g.:
+{
+    "output_dir": "ghac_results",
+    "cache_dir": "ghac_cache",
+    "workers": 4,
+    "graphs": [
+        {"name": "karate", "path": "data/graph_zachary.gml", "preprocessing": "gcc", "weight_param": "weight_uniform"},
+        {"name": "oecd_2019", "path": "data/oecd_trade_network_2019_symmetric.gml", "preprocessing": "normalized", "weight_param": "weight_normalized"}
+    ],
+    "configurations": [
+        {"linkage": "SINGLE", "min_base_size": 2, "bases_order": "ascending"},
+        {"linkage": "COMPLETE", "min_base_size": 3},
+        {"linkage": "AVERAGE", "ct_approximation_tolerance": 0.1, "random_state": 0, "compare_with_exact": true}
+    ]
+}
+
+Every graph is run with every configuration (a graph entry may hold its own "configurations" list instead).
+Graph entry may set "replace_unreachable_ct_distances", by default it is used for "normalized" preprocessing as in the OECD example.
+Preprocessed graphs and CT distance matrices are computed once per graph and stored in cache_dir,
+so repeated runs of the manifest skip the CT calculation. Cache files are keyed by graph name, path and preprocessing.
+Failed jobs are reported and the results of finished jobs are still written.
+Configuration with "ct_approximation_tolerance" (AVERAGE linkage only) runs approximate wGHAC, with "compare_with_exact"
+the exact hierarchy is calculated too and merge_order_difference between them is reported in the summary.
+Every job writes its results by GHACResultsWriter into output_dir/<graph>_<linkage>_<min_base_size>_<bases_order>,
+metrics of the best level (by modularity_eq) of every job are collected into output_dir/summary.parquet. Preparation of graphs
+(including CT calculation) and jobs are executed on one process pool, jobs of a graph are submitted when its preparation finishes.
+Every worker keeps the last loaded graph with its CT matrix and bases in memory for the following jobs on the same graph.
+"""
+
+GRAPH_PREPROCESSING = {
+    'gcc': run_ghac_community_detection.preprocess_graph_gcc,
+    'normalized': run_ghac_community_detection.preprocess_graph_normalized,
+}
+
+_prepared_graphs_cache = dict()
+_bases_cache = dict()
+
+def get_replace_unreachable_ct_distances(graph_entry:dict):
+    return graph_entry.get('replace_unreachable_ct_distances', graph_entry.get('preprocessing', 'gcc') == 'normalized')
+
+def get_cache_key(graph_entry:dict):
+    key_fields = [os.path.abspath(graph_entry['path']), graph_entry.get('preprocessing', 'gcc'), get_replace_unreachable_ct_distances(graph_entry)]
+    return f'{graph_entry["name"]}_{hashlib.sha1(json.dumps(key_fields).encode()).hexdigest()[:12]}'
+
+def get_cache_paths(cache_dir:str, cache_key:str):
+    return os.path.join(cache_dir, f'{cache_key}_graph.pkl'), os.path.join(cache_dir, f'{cache_key}_ct_distance_matrix.npy')
+
+def prepare_graph(graph_entry:dict, cache_dir:str):
+    cache_key = get_cache_key(graph_entry)
+    graph_path, ct_path = get_cache_paths(cache_dir, cache_key)
+    if os.path.exists(graph_path) and os.path.exists(ct_path):
+        return graph_path, ct_path
+    graph = nx.read_gml(graph_entry['path'])
+    graph_gcc = GRAPH_PREPROCESSING[graph_entry.get('preprocessing', 'gcc')](graph)
+    ct_distance_matrix = run_ghac_community_detection.compute_ct_distance_matrix(graph_gcc, tmp_dir=os.path.join(cache_dir, f'tmp_{cache_key}'), replace_unreachable_distances=get_replace_unreachable_ct_distances(graph_entry))
+    with open(graph_path, 'wb') as f:
+        pickle.dump(graph_gcc, f)
+    np.save(ct_path, ct_distance_matrix)
+    return graph_path, ct_path
+
+def load_prepared_graph(graph_path:str, ct_path:str):
+    if graph_path not in _prepared_graphs_cache:
+        # only the last graph is kept, CT matrices are dense N x N
+        _prepared_graphs_cache.clear()
+        _bases_cache.clear()
+        with open(graph_path, 'rb') as f:
+            graph_gcc = pickle.load(f)
+        _prepared_graphs_cache[graph_path] = (graph_gcc, np.load(ct_path))
+    return _prepared_graphs_cache[graph_path]
+
+def load_bases(graph_path:str, graph_gcc:nx.Graph, min_base_size:int, descending:bool):
+    key = (graph_path, min_base_size, descending)
+    if key not in _bases_cache:
+        _bases_cache[key] = run_ghac_community_detection.get_bases(graph_gcc, min_base_size, descending=descending)
+    return _bases_cache[key]
+
+def run_job(graph_name:str, graph_path:str, ct_path:str, weight_param:str, configuration:dict, output_dir:str):
+    graph_gcc, ct_distance_matrix = load_prepared_graph(graph_path, ct_path)
+    linkage = GHACLinkageMethod[configuration.get('linkage', 'SINGLE')]
+    min_base_size = configuration.get('min_base_size', 2)
+    bases_order = configuration.get('bases_order', 'descending')
+    cliques = load_bases(graph_path, graph_gcc, min_base_size, bases_order == 'descending')
+
+    ct_approximation_tolerance = configuration.get('ct_approximation_tolerance')
+
+    ghac = GraphAgglomerativeClusteringClosedTrail(graph_gcc, linkage, ct_distance_matrix, cliques, weight_param, ct_approximation_tolerance=ct_approximation_tolerance, random_state=configuration.get('random_state'))
+    linkage_matrix = ghac.run()
+    merge_order_difference = None
+    if ct_approximation_tolerance is not None and configuration.get('compare_with_exact', False):
+        ghac_exact = GraphAgglomerativeClusteringClosedTrail(graph_gcc, linkage, ct_distance_matrix, cliques, weight_param)
+        merge_order_difference = get_merge_order_difference(linkage_matrix, ghac_exact.run())
+    job_name = f'{graph_name}_{linkage.name}_{min_base_size}_{bases_order}'
+    if ct_approximation_tolerance is not None:
+        job_name += f'_tol{ct_approximation_tolerance}'
+    job_output_dir = os.path.join(output_dir, job_name)
+    with GHACResultsWriter(job_output_dir) as results_writer:
+        df_results = run_ghac_community_detection.evaluate_hierarchy(graph_gcc, linkage_matrix, cliques, weight_param=weight_param, ct_distance_matrix=ct_distance_matrix, plot_dendrograms=False, results_writer=results_writer)
+    if df_results is None:
+        return None
+
+    best = df_results.loc[df_results['modularity_eq'].astype(float).idxmax()].drop(labels=['communities']).to_dict()
+    best.update({'graph': graph_name, 'linkage': linkage.name, 'min_base_size': min_base_size, 'bases_order': bases_order, 'ct_approximation_tolerance': ct_approximation_tolerance, 'merge_order_difference': merge_order_difference, 'output_dir': job_output_dir})
+    return best
+
+def run_manifest(manifest:dict):
+    import pandas as pd
+    cache_dir = manifest.get('cache_dir', 'ghac_cache')
+    output_dir = manifest.get('output_dir', 'ghac_results')
+    os.makedirs(cache_dir, exist_ok=True)
+
+    results = list()
+    with concurrent.futures.ProcessPoolExecutor(max_workers=manifest.get('workers')) as executor:
+        preparation_futures = {executor.submit(prepare_graph, graph_entry, cache_dir): graph_entry for graph_entry in manifest['graphs']}
+        job_futures = dict()
+        pending = set(preparation_futures)
+        while len(pending) > 0:
+            done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                if future in preparation_futures:
+                    graph_entry = preparation_futures[future]
+                    try:
+                        graph_path, ct_path = future.result()
+                    except Exception:
+                        print(f'Failed preparation of {graph_entry["name"]}:')
+                        traceback.print_exc()
+                        continue
+                    weight_param = graph_entry.get('weight_param', 'weight_uniform')
+                    for configuration in graph_entry.get('configurations', manifest.get('configurations', [{}])):
+                        job_future = executor.submit(run_job, graph_entry['name'], graph_path, ct_path, weight_param, configuration, output_dir)
+                        job_futures[job_future] = (graph_entry['name'], configuration)
+                        pending.add(job_future)
+                    continue
+
+                graph_name, configuration = job_futures[future]
+                try:
+                    best = future.result()
+                except Exception:
+                    print(f'Failed {graph_name} {configuration}:')
+                    traceback.print_exc()
+                    continue
+                if best is None:
+                    print(f'No levels evaluated for {graph_name} {configuration}.')
+                    continue
+                print(f'Finished {graph_name} {configuration}, results in {best["output_dir"]}.')
+                results.append(best)
+
+    if len(results) == 0:
+        return None
+    df_summary = pd.DataFrame(results).infer_objects()
+    summary_filename = os.path.join(output_dir, 'summary.parquet')
+    df_summary.to_parquet(summary_filename, index=False)
+    print(f'File {summary_filename} created.')
+    return df_summary
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run wGHAC for graphs and configurations listed in a manifest.')
+    parser.add_argument('manifest', help='path to JSON manifest')
+    args = parser.parse_args()
+    with open(args.manifest) as f:
+        run_manifest(json.load(f))
@@ -1,24 +1,22 @@
 import networkx as nx
-import matplotlib.pyplot as plt
-import scipy.sparse
-import pandas as pd
 import numpy as np
-import itertools
-import pickle
 import os
-import math
-import scipy.cluster.hierarchy
-import scipy.spatial.distance
-import cdlib
-import cdlib.algorithms
+import shutil
+import subprocess
 
 from graph_hierarchical_agglomerative_clustering import GHACLinkageMethod, GraphAgglomerativeClusteringClosedTrail
 import functions
+from results_writer import GHACResultsWriter
+# pandas, scipy and matplotlib are imported on first use, so the graph preparation can be imported quickly
 
-def evaluate_hierarchy(graph:nx.Graph, linkage_matrix:np.ndarray, bases:list, weight_param:str=None, min_distance_in_modularity_calculation:float=0.000, xlim:tuple[int, int]=None, figsize:tuple[int, int]=(12,12), ground_truth_communities:list|None=None, plot_dendrograms:bool=True, ct_distance_matrix:np.ndarray=None):
+def evaluate_hierarchy(graph:nx.Graph, linkage_matrix:np.ndarray, bases:list, weight_param:str=None, min_distance_in_modularity_calculation:float=0.000, xlim:tuple[int, int]=None, figsize:tuple[int, int]=(12,12), ground_truth_communities:list|None=None, plot_dendrograms:bool=True, ct_distance_matrix:np.ndarray=None, results_writer=None, dendrogram_truncate_p:int|None=100):
+    import pandas as pd
+    import scipy.cluster.hierarchy
     dendrogram_modularity_info = dict()
     levels_for_calculation = list()
     distance_vector = linkage_matrix[:, 2].copy()
+    if results_writer is not None:
+        results_writer.write_hierarchy(linkage_matrix, bases, graph.number_of_nodes())
     linkage_matrix[:, 2] = range(1, linkage_matrix.shape[0]+1)
     
     for level in np.unique(linkage_matrix[:, 2]):
@@ -62,11 +60,14 @@ def evaluate_hierarchy(graph:nx.Graph, linkage_matrix:np.ndarray, bases:list, we
         cd_evaluation['silhouette_maxsi'] = max_silhouette_scores
 
         dendrogram_modularity_info[level] = cd_evaluation
+        if results_writer is not None:
+            results_writer.write_level(level, cd_evaluation, graph.number_of_nodes())
     
     if len(dendrogram_modularity_info) == 0:
         return None
 
     if plot_dendrograms:
+        import matplotlib.pyplot as plt
         best_modularity_distance = max(dendrogram_modularity_info, key=lambda k: dendrogram_modularity_info[k]['modularity_eq'])
         metrics = ['silhouette', 'modularity_overlap', 'conductance_weighted']
         x_ticks = levels_for_calculation
@@ -84,14 +85,16 @@ def evaluate_hierarchy(graph:nx.Graph, linkage_matrix:np.ndarray, bases:list, we
             if xlim is not None:
                 ax.set_xlim(xlim)
         ax2 = axs[-1]
+        # only last dendrogram_truncate_p merged clusters are plotted, smaller hierarchies are plotted whole
+        truncate_kwargs = dict(truncate_mode='lastp', p=dendrogram_truncate_p) if dendrogram_truncate_p is not None else dict()
         if 'original_label' in graph.nodes(data=True)[0]:
             node_labels = list(nx.get_node_attributes(graph, 'original_label').values())
             relabeled_bases = list()
             for base in bases:
                 relabeled_bases.append(', '.join(sorted([node_labels[node] for node in base])))
-            scipy.cluster.hierarchy.dendrogram(linkage_matrix, orientation='right', ax=ax2, labels=relabeled_bases, color_threshold=best_modularity_distance + 0.001)
+            scipy.cluster.hierarchy.dendrogram(linkage_matrix, orientation='right', ax=ax2, labels=relabeled_bases, color_threshold=best_modularity_distance + 0.001, **truncate_kwargs)
         else:
-            scipy.cluster.hierarchy.dendrogram(linkage_matrix, orientation='right', ax=ax2, labels=bases, color_threshold=best_modularity_distance + 0.001)
+            scipy.cluster.hierarchy.dendrogram(linkage_matrix, orientation='right', ax=ax2, labels=bases, color_threshold=best_modularity_distance + 0.001, **truncate_kwargs)
         plt.xlabel('step')
         ax2.set_title('Dendrogram')
         ax2.xaxis.set_ticks(levels_for_calculation)
@@ -101,36 +104,69 @@ def evaluate_hierarchy(graph:nx.Graph, linkage_matrix:np.ndarray, bases:list, we
 
     return pd.DataFrame(dendrogram_modularity_info).T.reset_index()
 
-def test_karate():
-    graph_filename = 'data/graph_zachary.gml'
-    min_base_size = 2
-    linkage = GHACLinkageMethod.SINGLE
-
-    # preprocess graph
-    graph = nx.read_gml(graph_filename)
+def preprocess_graph_gcc(graph:nx.Graph):
     nx.set_edge_attributes(graph, 1, 'weight_uniform')
     graph.remove_edges_from(nx.selfloop_edges(graph))
     graph.remove_edges_from(list(nx.bridges(graph)))
     graph_gcc = nx.subgraph(graph, max(nx.connected_components(graph), key=len))
     graph_gcc = nx.convert_node_labels_to_integers(graph_gcc, label_attribute='original_label')
     nx.set_edge_attributes(graph_gcc, dict([((u,v),1/w) for u,v,w in graph_gcc.edges(data='weight')]), 'cost')
+    return graph_gcc
+
+def preprocess_graph_normalized(graph:nx.Graph):
+    nx.set_edge_attributes(graph, 1, 'weight_uniform')
+    # graph.remove_edges_from(nx.selfloop_edges(graph))
+    # graph.remove_edges_from(list(nx.bridges(graph)))
+    # graph_gcc = nx.subgraph(graph, max(nx.connected_components(graph), key=len))
+    graph_gcc = graph.copy()
+    graph_gcc = nx.convert_node_labels_to_integers(graph_gcc, first_label=0, ordering='sorted', label_attribute='original_label')
     
-    # compute CT distance matrix
-    os.system('mkdir tmp_files')    
-    nx.write_gml(graph_gcc, 'tmp_files/graph_gcc.gml')
-    nx.write_edgelist(graph_gcc, 'tmp_files/graph_gcc.csv', delimiter=' ', data=['cost'])
-    os.system('closed_trail_distance_binary/efficient_suurballe\
-                tmp_files/graph_gcc.csv edgelist full\
-                tmp_files/graph_gcc_distance_matrix.csv')
-    ct_distance_matrix = np.loadtxt('tmp_files/graph_gcc_distance_matrix.csv', dtype=np.float32, delimiter='\t')
-    os.system('rm -rf tmp_files')
+    def normalize2(x, min, max):
+            return (2*(x - min) / (max-min)) + 1
+    min_weight = min([graph_gcc[u][v]['weight'] for u, v in graph_gcc.edges()])
+    max_weight = max([graph_gcc[u][v]['weight'] for u, v in graph_gcc.edges()])
+    nx.set_edge_attributes(graph_gcc, {(u,v): {'weight_normalized': normalize2(w, min_weight, max_weight)} for u,v,w in graph_gcc.edges(data='weight')})
+    nx.set_edge_attributes(graph_gcc, dict([((u,v),1/w) for u,v,w in graph_gcc.edges(data='weight_normalized')]), 'cost')
+    return graph_gcc
+
+def compute_ct_distance_matrix(graph_gcc:nx.Graph, tmp_dir:str='tmp_files', replace_unreachable_distances:bool=False):
+    os.makedirs(tmp_dir, exist_ok=True)
+    try:
+        nx.write_gml(graph_gcc, os.path.join(tmp_dir, 'graph_gcc.gml'))
+        nx.write_edgelist(graph_gcc, os.path.join(tmp_dir, 'graph_gcc.csv'), delimiter=' ', data=['cost'])
+        subprocess.run(['closed_trail_distance_binary/efficient_suurballe',
+                        os.path.join(tmp_dir, 'graph_gcc.csv'), 'edgelist', 'full',
+                        os.path.join(tmp_dir, 'graph_gcc_distance_matrix.csv')], check=True)
+        ct_distance_matrix = np.loadtxt(os.path.join(tmp_dir, 'graph_gcc_distance_matrix.csv'), dtype=np.float32, delimiter='\t')
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    # distance between disconnected nodes is replaced by large value
+    if replace_unreachable_distances and ct_distance_matrix.max() > 1000:
+        ct_distance_matrix[ct_distance_matrix == ct_distance_matrix.max()] = 998
+    return ct_distance_matrix
 
-    # get bases (cliques) for GHAC
+def get_bases(graph_gcc:nx.Graph, min_base_size:int=2, descending:bool=True):
     cliques = list()
     for clique in nx.find_cliques(graph_gcc):
         if len(clique) >= min_base_size:
             cliques.append(tuple(sorted([int(node) for node in clique])))
-    cliques = list(sorted(cliques, key=len, reverse=False))
+    return list(sorted(cliques, key=len, reverse=descending))
+
+def test_karate():
+    import pandas as pd
+    graph_filename = 'data/graph_zachary.gml'
+    min_base_size = 2
+    linkage = GHACLinkageMethod.SINGLE
+
+    # preprocess graph
+    graph = nx.read_gml(graph_filename)
+    graph_gcc = preprocess_graph_gcc(graph)
+    
+    # compute CT distance matrix
+    ct_distance_matrix = compute_ct_distance_matrix(graph_gcc)
+
+    # get bases (cliques) for GHAC
+    cliques = get_bases(graph_gcc, min_base_size, descending=False)
 
     # run GHAC
     print('-'*50)
@@ -141,7 +177,8 @@ def test_karate():
     # evaluate hierarchy, plot dendrogram and show best coverage
     print('-'*50)
     print('Evaluation of hierarchical structure...')
-    df_results = evaluate_hierarchy(graph_gcc, linkage_matrix, cliques, weight_param='weight_uniform', ct_distance_matrix=ct_distance_matrix)
+    with GHACResultsWriter('output_karate') as results_writer:
+        df_results = evaluate_hierarchy(graph_gcc, linkage_matrix, cliques, weight_param='weight_uniform', ct_distance_matrix=ct_distance_matrix, results_writer=results_writer)
     print('-'*50)
     print('The best network covers identified by different modularities:')
     df_best = functions.get_best_split_results(df_results)
@@ -149,6 +186,7 @@ def test_karate():
         print(df_best[['modularity', 'max_val', 'comms_len', 'communities']])
 
 def run_oecd_trade_network():
+    import pandas as pd
     graph_filename = 'data/oecd_trade_network_2019_symmetric.gml'
     min_base_size = 2
     linkage = GHACLinkageMethod.COMPLETE
@@ -156,38 +194,13 @@ def run_oecd_trade_network():
     # preprocess graph
     graph = nx.read_gml(graph_filename)
     print(f'Number of nodes: {graph.number_of_nodes()}, number of edges: {graph.number_of_edges()}')
-    nx.set_edge_attributes(graph, 1, 'weight_uniform')
-    # graph.remove_edges_from(nx.selfloop_edges(graph))
-    # graph.remove_edges_from(list(nx.bridges(graph)))
-    # graph_gcc = nx.subgraph(graph, max(nx.connected_components(graph), key=len))
-    graph_gcc = graph.copy()
-    graph_gcc = nx.convert_node_labels_to_integers(graph_gcc, first_label=0, ordering='sorted', label_attribute='original_label')
-    
-    def normalize2(x, min, max):
-            return (2*(x - min) / (max-min)) + 1
-    min_weight = min([graph_gcc[u][v]['weight'] for u, v in graph_gcc.edges()])
-    max_weight = max([graph_gcc[u][v]['weight'] for u, v in graph_gcc.edges()])
-    nx.set_edge_attributes(graph_gcc, {(u,v): {'weight_normalized': normalize2(w, min_weight, max_weight)} for u,v,w in graph_gcc.edges(data='weight')})
-    nx.set_edge_attributes(graph_gcc, dict([((u,v),1/w) for u,v,w in graph_gcc.edges(data='weight_normalized')]), 'cost')
+    graph_gcc = preprocess_graph_normalized(graph)
 
     # compute CT distance matrix
-    os.system('mkdir tmp_files')    
-    nx.write_gml(graph_gcc, 'tmp_files/graph_gcc.gml')
-    nx.write_edgelist(graph_gcc, 'tmp_files/graph_gcc.csv', delimiter=' ', data=['cost'])
-    os.system('closed_trail_distance_binary/efficient_suurballe\
-                tmp_files/graph_gcc.csv edgelist full\
-                tmp_files/graph_gcc_distance_matrix.csv')
-    ct_distance_matrix = np.loadtxt('tmp_files/graph_gcc_distance_matrix.csv', dtype=np.float32, delimiter='\t')
-    if ct_distance_matrix.max() > 1000:
-        ct_distance_matrix[ct_distance_matrix == ct_distance_matrix.max()] = 998
-    os.system('rm -rf tmp_files')
+    ct_distance_matrix = compute_ct_distance_matrix(graph_gcc, replace_unreachable_distances=True)
 
     # get bases (cliques) for GHAC
-    cliques = list()
-    for clique in nx.find_cliques(graph_gcc):
-        if len(clique) >= min_base_size:
-            cliques.append(tuple(sorted([int(node) for node in clique])))
-    cliques = list(sorted(cliques, key=len, reverse=True))
+    cliques = get_bases(graph_gcc, min_base_size, descending=True)
 
     # run GHAC
     print('-'*50)
@@ -198,7 +211,8 @@ def run_oecd_trade_network():
     # evaluate hierarchy, plot dendrogram and show best coverage
     print('-'*50)
     print('Evaluation of hierarchical structure...')
-    df_results = evaluate_hierarchy(graph_gcc, linkage_matrix, cliques, weight_param='weight_normalized', ct_distance_matrix=ct_distance_matrix)
+    with GHACResultsWriter('output_oecd_trade_network') as results_writer:
+        df_results = evaluate_hierarchy(graph_gcc, linkage_matrix, cliques, weight_param='weight_normalized', ct_distance_matrix=ct_distance_matrix, results_writer=results_writer)
     print('-'*50)
     print('The best network covers identified by different modularities:')
     df_best = functions.get_best_split_results(df_results)